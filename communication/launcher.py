@@ -5,8 +5,16 @@ import os
 import time
 import json
 import logging
-import paho.mqtt.client as mqtt
-import subprocess
+import multiprocessing
+import multiprocessing.forkserver
+import runpy
+import queue
+import threading
+import socket
+import signal
+from pymosquitto import Mosquitto
+from pymosquitto.client import MosquittoError
+from pymosquitto.constants import ErrorCode
 
 # --- CONFIGURE THIS FOR EACH JETSON ---
 JETSON_ID = "1"  # E.g., "1", "2", "3"
@@ -17,12 +25,26 @@ JETSON_ID = "1"  # E.g., "1", "2", "3"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 MAIN_SCRIPT_PATH = os.path.join(SCRIPT_DIR, "jetson5.py")
 
+# --- Warm start ---
+# jetson5.py is forked from a single-threaded forkserver rather than from the launcher, whose
+# MQTT and worker threads make fork() unsafe. The forkserver imports warm_start.py once,
+# preloading the heavy libraries that every forked jetson5.py process then inherits.
+PROCESS_CONTEXT = multiprocessing.get_context("forkserver")
+PROCESS_CONTEXT.set_forkserver_preload(["warm_start"])
+
 # --- MQTT Configuration ---
 MQTT_BROKER_HOST = "192.168.1.47" # Use the Raspi's IP
 MQTT_BROKER_PORT = 1999
 MQTT_TOPIC_COMMAND = f"avi/jetson/{JETSON_ID}/command"
 MQTT_TOPIC_STATUS = f"avi/status/jetson/launcher" # A new topic to report launcher status
 MQTT_CLIENT_ID = f"jetson-launcher-{JETSON_ID}"
+# Back off reconnects from 1 s up to 60 s so the Jetsons don't hammer a restarting broker
+MQTT_RECONNECT_DELAY_MIN = 1
+MQTT_RECONNECT_DELAY_MAX = 60
+# TCP keepalive on the broker socket: a dead broker is detected after ~30 s (10 + 4 * 5)
+TCP_KEEPALIVE_IDLE = 10
+TCP_KEEPALIVE_INTERVAL = 5
+TCP_KEEPALIVE_COUNT = 4
 
 # --- Logging ---
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] (%(threadName)-10s) %(message)s')
@@ -31,34 +53,62 @@ log = logging.getLogger()
 # --- Global process handle ---
 process_handle = None
 
-def on_connect(client, userdata, flags, reason_code, properties):
+# --- Start/stop commands, run in order off the MQTT callback thread ---
+# Seconds a stopped process gets to exit after SIGTERM before it is killed
+STOP_GRACE_PERIOD = 5
+command_queue = queue.Queue()
+
+def enable_tcp_keepalive(client):
+    """Turns on TCP keepalive for the broker connection, faster than the MQTT keepalive."""
+    fd = client.socket()
+    if fd is None:
+        return
+    # fromfd() duplicates the descriptor; the options apply to the shared socket
+    with socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+
+def on_connect(client, userdata, reason_code):
     if reason_code == 0:
         log.info(f"Connected to MQTT Broker at {MQTT_BROKER_HOST}")
+        try:
+            enable_tcp_keepalive(client)
+        except OSError as e:
+            log.warning(f"Could not enable TCP keepalive: {e}")
         # Subscribe to the command topic
         client.subscribe(MQTT_TOPIC_COMMAND, qos=1)
         log.info(f"Subscribed to command topic: {MQTT_TOPIC_COMMAND}")
-        # Publish online status
+        # Publish online status (retained QoS 0: no PUBACK round-trip needed)
         online_payload = json.dumps({
             "id": JETSON_ID, 
             "id_full": f"jetson-launcher-{JETSON_ID}", 
             "status": "online"
         })
-        client.publish(MQTT_TOPIC_STATUS, online_payload, qos=1, retain=True)
+        client.publish(MQTT_TOPIC_STATUS, online_payload, qos=0, retain=True)
     else:
         log.error(f"Failed to connect to MQTT, return code {reason_code}")
 
-def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+def on_disconnect(client, userdata, reason_code):
     log.warning(f"Unexpected disconnection from MQTT Broker. (rc: {reason_code})")
 
+def run_main_script():
+    """Entry point of the forked child: runs jetson5.py as if it were started directly."""
+    sys.argv = [MAIN_SCRIPT_PATH]
+    runpy.run_path(MAIN_SCRIPT_PATH, run_name="__main__")
+
 def start_process():
     """Starts the main jetson5.py script."""
     global process_handle
-    if process_handle is None or process_handle.poll() is not None:
+    if process_handle is None or not process_handle.is_alive():
         try:
             log.info(f"Starting script: {MAIN_SCRIPT_PATH}")
-            # Start the main script as a new process
-            # We use sys.executable to ensure we're using the same Python interpreter
-            process_handle = subprocess.Popen([sys.executable, MAIN_SCRIPT_PATH])
+            # Forked by the warm forkserver instead of spawning a new interpreter, so the
+            # preloaded modules are shared copy-on-write and the start is near-instant
+            process_handle = PROCESS_CONTEXT.Process(target=run_main_script, name="jetson5")
+            process_handle.start()
             log.info(f"Process started with PID: {process_handle.pid}")
             return True
         except Exception as e:
@@ -69,20 +119,22 @@ def start_process():
         return False
 
 def stop_process():
-    """Stops the main jetson5.py script."""
+    """Stops the main jetson5.py script, escalating from SIGTERM to SIGKILL."""
     global process_handle
-    if process_handle and process_handle.poll() is None:
+    if process_handle and process_handle.is_alive():
         try:
             log.info(f"Stopping process with PID: {process_handle.pid}...")
             # Send a SIGTERM signal to allow graceful shutdown
             process_handle.terminate() 
-            # Wait for 5 seconds for it to close
-            process_handle.wait(timeout=5)
-            log.info("Process terminated.")
-        except subprocess.TimeoutExpired:
-            log.warning("Process did not terminate gracefully. Forcing kill...")
-            process_handle.kill() # Force kill
-            log.info("Process killed.")
+            # Wait for it to close; this runs on the process worker, not the MQTT callback
+            process_handle.join(timeout=STOP_GRACE_PERIOD)
+            if process_handle.is_alive():
+                log.warning(f"Process {process_handle.pid} did not terminate gracefully. Forcing kill...")
+                process_handle.kill() # Force kill
+                process_handle.join()
+                log.info(f"Process {process_handle.pid} killed.")
+            else:
+                log.info(f"Process {process_handle.pid} terminated.")
         except Exception as e:
             log.error(f"Error while stopping process: {e}", exc_info=True)
         finally:
@@ -92,6 +144,42 @@ def stop_process():
         log.warning("Process is not running. Ignoring stop command.")
         return False
 
+def process_worker():
+    """Runs queued start/stop commands one at a time, so a start waits for an earlier stop
+    to release the camera while the MQTT callback itself returns immediately."""
+    while True:
+        command = command_queue.get()
+        try:
+            if command == "start":
+                start_process()
+            elif command == "stop":
+                stop_process()
+        except Exception as e:
+            log.error(f"Error running {command} command: {e}", exc_info=True)
+        finally:
+            command_queue.task_done()
+
+def connect_with_backoff(client, shutdown_requested):
+    """Connects to the broker, retrying with the same backoff as libmosquitto's reconnects.
+
+    Returns False if shutdown was requested before a connection was made. Only invalid
+    settings are raised; a broker that is down or still booting is simply retried.
+    """
+    attempt = 0
+    while not shutdown_requested.is_set():
+        try:
+            client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
+            return True
+        except MosquittoError as e:
+            if e.code == ErrorCode.INVAL:
+                raise
+            attempt += 1
+            # Same curve as reconnect_delay_set(..., exponential=True): min * attempts^2, capped
+            delay = min(MQTT_RECONNECT_DELAY_MIN * attempt * attempt, MQTT_RECONNECT_DELAY_MAX)
+            log.warning(f"Could not connect to MQTT broker: {e}. Retrying in {delay} s...")
+            shutdown_requested.wait(delay)
+    return False
+
 def on_message(client, userdata, msg):
     """Handles incoming commands."""
     global process_handle
@@ -101,10 +189,8 @@ def on_message(client, userdata, msg):
         
         log.info(f"Received command: {command}")
         
-        if command == "start":
-            start_process()
-        elif command == "stop":
-            stop_process()
+        if command in ("start", "stop"):
+            command_queue.put(command)
         else:
             log.warning(f"Unknown command: {command}")
             
@@ -115,30 +201,52 @@ def on_message(client, userdata, msg):
 
 def main():
     log.info(f"--- Starting Jetson Launcher {JETSON_ID} ---")
+    # Start the forkserver now, so the preload is done before the first start command
+    multiprocessing.forkserver.ensure_running()
+    threading.Thread(target=process_worker, name="Process", daemon=True).start()
     
-    # Set up Last Will and Testament (LWT)
+    # Set up Last Will and Testament (LWT), retained at QoS 0 like the online status
     lwt_payload = json.dumps({
         "id": JETSON_ID, 
         "id_full": f"jetson-launcher-{JETSON_ID}", 
         "status": "offline"
     })
     
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=MQTT_CLIENT_ID)
+    # libmosquitto-backed client: lighter callback dispatch and RSS than Paho on the Jetson
+    # Persistent session: QoS 1 commands sent while we are briefly offline are delivered on reconnect
+    client = Mosquitto(client_id=MQTT_CLIENT_ID, clean_start=False)
+    client.reconnect_delay_set(MQTT_RECONNECT_DELAY_MIN, MQTT_RECONNECT_DELAY_MAX, True)
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
-    client.will_set(MQTT_TOPIC_STATUS, payload=lwt_payload, qos=1, retain=True)
+    lwt_bytes = lwt_payload.encode('utf-8')
+    client.will_set(MQTT_TOPIC_STATUS, len(lwt_bytes), lwt_bytes, 0, True)
+
+    # The network loop runs on libmosquitto's own thread; the main thread only waits for a
+    # signal, since Python handlers cannot run while the main thread is blocked inside C
+    shutdown_requested = threading.Event()
+    def request_shutdown(signum, frame):
+        shutdown_requested.set()
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
 
+    loop_started = False
     try:
-        client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
-        client.loop_forever() # This blocks and handles all MQTT traffic
-    except KeyboardInterrupt:
+        # Retry here instead of exiting, so systemd doesn't restart (and re-preload) every few seconds
+        if connect_with_backoff(client, shutdown_requested):
+            client.loop_start() # Handles all MQTT traffic in the background
+            loop_started = True
+            while not shutdown_requested.wait(1):
+                pass
         log.info("Launcher shutting down...")
     except Exception as e:
-        log.error(f"FATAL: Could not connect to MQTT broker: {e}")
+        log.error(f"FATAL: MQTT client error: {e}")
     finally:
-        stop_process() # Ensure the child process is stopped on exit
-        client.disconnect()
+        command_queue.put("stop") # Ensure the child process is stopped on exit
+        command_queue.join()
+        client.disconnect(strict=False)
+        if loop_started:
+            client.loop_stop(False)
         log.info("Launcher shut down cleanly.")
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+# Imported once by the launcher's forkserver (see PROCESS_CONTEXT in launcher.py).
+# Every jetson5.py process is forked from the forkserver and inherits these modules,
+# so a start command does not pay the import cost again.
+
+import importlib
+import logging
+
+# Nothing here may initialise CUDA or the Pylon runtime, which do not survive a fork,
+# so pypylon is left for the child to import.
+PRELOAD_MODULES = ["numpy", "cv2", "PIL.Image", "torch", "torchvision", "paho.mqtt.client"]
+
+# The forkserver does not run the launcher's logging setup, so configure the same format here
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] (%(threadName)-10s) %(message)s')
+log = logging.getLogger()
+
+def preload_modules():
+    """Imports the main script's heavy dependencies once, so forked children start warm."""
+    for module_name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module_name)
+            log.info(f"Preloaded module: {module_name}")
+        except Exception as e:
+            # A broken optional library must not take the forkserver down with it
+            log.warning(f"Could not preload module {module_name}: {e}")
+
+preload_modules()
@@ -6,10 +6,20 @@ from tkinter import ttk, messagebox
 from pypylon import pylon
 import numpy as np
 import threading
+import queue
 from PIL import Image, ImageTk
 import socket
 import time
 import struct
+import select
+import fcntl
+import termios
+
+try:
+    # Hardware JPEG encoder on Jetson (pip install pynvjpeg); falls back to OpenCV if missing
+    from nvjpeg import NvJpeg
+except ImportError:
+    NvJpeg = None
 
 # --- CONFIGURATION ---
 # !!! IMPORTANT: Set a unique ID (1-6) for each Jetson !!!
@@ -19,6 +29,20 @@ JETSON_ID = 1
 RPI_IP_ADDRESS = "10.10.10.8"
 # ---------------------
 
+# Frame header: [ID (1 byte)][LENGTH (4 bytes, big-endian)], compiled once.
+# The 4-byte length caps a single frame at 4 GB, far above any JPEG we send.
+_HDR = struct.Struct('>BL')
+
+# Camera pixel formats for colour output, in order of preference. Bayer keeps USB3 traffic at
+# one byte per pixel and is demosaiced by the converter; BGR8/RGB8 cover cameras without it.
+COLOR_PIXEL_FORMATS = ('BayerRG8', 'BayerBG8', 'BayerGB8', 'BayerGR8', 'BGR8', 'RGB8')
+
+# A dead link must not block connect() indefinitely
+CONNECT_TIMEOUT = 5.0
+
+# Longest we wait for a frame to be acknowledged when timing the link; well above the slow-link threshold
+DELIVERY_TIMEOUT = 2.0
+
 
 class RealTimeAnalysisApp:
     def __init__(self, root, rpi_ip, jetson_id):
@@ -34,48 +58,239 @@ class RealTimeAnalysisApp:
         self.root.geometry(f"{screen_width}x{screen_height}")
         self.processing_width = 1280
         self.processing_height = 720
+        # The local preview is shown at reduced size; full-res frames are still sent
+        self.preview_width = 640
+        self.preview_height = 360
 
         # Camera variables
         self.camera_running = False
         self.camera = None
         self.converter = None
+        self.jpeg_encoder = None
+        # Lowered when sends are slow, raised again once the link has headroom
+        self.jpeg_quality = 90
+        # Frames whose 64-bit average hash is within this many bits of the last sent one are skipped
+        self.scene_change_threshold = 5
+        self.last_sent_hash = None
+        # Send anyway after this many skips in a row, so a restarted receiver gets a picture
+        self.max_skipped_frames = 10
+        self.skipped_frames = 0
 
         # Control variables
         self.exposure_value = tk.IntVar(value=5000)
         self.brightness_value = tk.DoubleVar(value=0.0)
         self.contrast_value = tk.DoubleVar(value=0.0)
+        # Mono8 halves USB3 traffic and JPEG size; colour is opt-in, applied on the next camera start
+        self.color_value = tk.BooleanVar(value=False)
+        self.color_output = False
+
+        # Control changes are written to the camera once, not on every frame
+        self.pending_camera_updates = {}
+        self.camera_update_lock = threading.Lock()
+        self.exposure_value.trace_add('write', lambda *args: self._queue_camera_update('ExposureTime', self.exposure_value))
+        self.brightness_value.trace_add('write', lambda *args: self._queue_camera_update('BslBrightness', self.brightness_value))
+        self.contrast_value.trace_add('write', lambda *args: self._queue_camera_update('BslContrast', self.contrast_value))
 
         # Networking
+        # Pipeline: capture -> encode_q -> encoder thread -> send_q -> sender thread
         self.latest_frame = None
+        self.encode_q = queue.Queue(maxsize=1)
+        self.send_q = queue.Queue(maxsize=1)
+        self.encode_thread = None
         self.send_thread = None
+        self.sock = None
         self.stop_sending = threading.Event()
 
         self.setup_gui()
 
-    def send_image_periodically(self):
-        """Periodically sends the latest captured frame with a prepended ID."""
-        while not self.stop_sending.is_set():
-            if self.latest_frame is not None:
+    def _peer_closed(self, sock):
+        """Returns True if the Raspberry Pi has closed the connection."""
+        # The receiver never sends anything, so a readable socket means EOF or a reset
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _open_connection(self):
+        """Opens a new connection to the Raspberry Pi."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Send the header and image immediately instead of letting Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect((self.rpi_ip, self.rpi_port))
+        except OSError:
+            sock.close()
+            raise
+        # Sends stay blocking; stop_camera interrupts them with shutdown()
+        sock.settimeout(None)
+        return sock
+
+    def _close_socket(self, sock):
+        """Closes a sender's connection so its next send reconnects."""
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+            # Only forget the published connection if it is this one, not a newer run's
+            if self.sock is sock:
+                self.sock = None
+        # The receiver may have missed the last frame, so send the next one even if unchanged
+        self.last_sent_hash = None
+
+    def _send_frame(self, sock, header, data):
+        """Sends the header and image in one gathered write instead of concatenating them."""
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(header)
+            sock.sendall(data)
+            return
+        sent = sock.sendmsg([header, data])
+        # sendmsg may accept only part of the frame; finish the remainder with sendall
+        if sent < len(header):
+            sock.sendall(header[sent:])
+            sock.sendall(data)
+        elif sent < len(header) + len(data):
+            sock.sendall(memoryview(data)[sent - len(header):])
+
+    def _unacked_bytes(self, sock):
+        """Returns the bytes still in the kernel send queue, i.e. not yet acknowledged by the Pi."""
+        # TIOCOUTQ is SIOCOUTQ for TCP sockets on Linux
+        queued = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, struct.pack('i', 0))
+        return struct.unpack('i', queued)[0]
+
+    def _wait_for_delivery(self, sock, stop_event):
+        """Waits until the send queue drains, so the caller can time actual delivery to the Pi."""
+        deadline = time.monotonic() + DELIVERY_TIMEOUT
+        while self._unacked_bytes(sock) > 0 and time.monotonic() < deadline:
+            if stop_event.wait(0.005):
+                return
+
+    def _adapt_jpeg_quality(self, send_time):
+        """Trades JPEG quality for size when the link is slow, and back when it recovers."""
+        if send_time > 0.25:
+            self.jpeg_quality = max(40, self.jpeg_quality - 10)
+        elif send_time < 0.05:
+            self.jpeg_quality = min(90, self.jpeg_quality + 10)
+
+    def encode_jpeg(self, frame):
+        """Compresses a BGR or greyscale frame to JPEG bytes, using NVJPEG for colour when available."""
+        if self.jpeg_encoder is not None and frame.ndim == 3:
+            return self.jpeg_encoder.encode(frame, self.jpeg_quality)
+        _, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+        return buffer.tobytes()
+
+    def _put_latest(self, q, item):
+        """Puts an item on a size-1 queue, discarding the stale entry if it is full."""
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
                 try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.connect((self.rpi_ip, self.rpi_port))
-                        
-                        # Compress the frame to JPEG
-                        _, buffer = cv2.imencode('.jpg', self.latest_frame, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-                        data = buffer.tobytes()
-                        
-                        # NEW PROTOCOL: [ID][LENGTH][IMAGE DATA]
-                        # Pack the ID (1 byte) and the length (4 bytes, big-endian)
-                        header = struct.pack('>BL', self.jetson_id, len(data))
-                        
-                        # Send the header followed by the image data
-                        s.sendall(header + data)
-                        print(f"Sent {len(data)} bytes to Raspberry Pi from ID {self.jetson_id}.")
-                except Exception as e:
-                    print(f"Failed to send image: {e}")
-            
-            # Wait for 30 seconds before sending the next image
-            time.sleep(30)
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _drain_queue(self, q):
+        """Empties a queue, returning False if a stop sentinel was among the items."""
+        try:
+            while True:
+                if q.get_nowait() is None:
+                    return False
+        except queue.Empty:
+            return True
+
+    def _take_fresh_frame(self, encode_q, stop_event):
+        """Waits for a frame grabbed after this call; returns None when sending stops."""
+        if not self._drain_queue(encode_q):
+            return None
+        while not stop_event.is_set():
+            try:
+                return encode_q.get(timeout=1.0)
+            except queue.Empty:
+                continue
+        return None
+
+    def _frame_hash(self, frame):
+        """Returns a 64-bit average hash: an 8x8 greyscale thumbnail thresholded at its mean."""
+        small = cv2.resize(frame, (8, 8), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return int.from_bytes(np.packbits(small > small.mean()).tobytes(), 'big')
+
+    def _encoder_thread(self, encode_q, send_q, stop_event):
+        """Periodically compresses the freshest captured frame and hands it to the sender."""
+        while not stop_event.is_set():
+            frame = self._take_fresh_frame(encode_q, stop_event)
+            if frame is None:
+                break
+
+            try:
+                # Skip the encode and send entirely when the scene has not changed
+                frame_hash = self._frame_hash(frame)
+                sock = self.sock
+                if (self.last_sent_hash is not None
+                        and bin(frame_hash ^ self.last_sent_hash).count('1') <= self.scene_change_threshold
+                        and self.skipped_frames < self.max_skipped_frames
+                        and sock is not None and not self._peer_closed(sock)):
+                    self.skipped_frames += 1
+                    print(f"Skipped unchanged frame from ID {self.jetson_id}.")
+                else:
+                    # Compress the frame to JPEG
+                    self._put_latest(send_q, self.encode_jpeg(frame))
+                    self.last_sent_hash = frame_hash
+                    self.skipped_frames = 0
+            except Exception as e:
+                print(f"Failed to encode image: {e}")
+
+            # Wait for 30 seconds before encoding the next image (returns early on stop)
+            stop_event.wait(30)
+
+    def _sender_thread(self, send_q, stop_event):
+        """Sends encoded frames with a prepended ID over the persistent connection."""
+        sock = None
+        while True:
+            data = send_q.get()
+            # A frame can overtake the sentinel if the encoder outlived stop_camera's join timeout
+            if data is None or stop_event.is_set():
+                break
+
+            try:
+                if sock is not None and self._peer_closed(sock):
+                    # Sending into a closed connection would appear to succeed and lose the frame
+                    self._close_socket(sock)
+                    sock = None
+                if sock is None:
+                    sock = self._open_connection()
+                    # stop_camera may have given up on this thread while it was connecting
+                    if stop_event.is_set():
+                        break
+                    self.sock = sock
+                
+                # NEW PROTOCOL: [ID][LENGTH][IMAGE DATA]
+                # Pack the ID (1 byte) and the length (4 bytes, big-endian)
+                header = _HDR.pack(self.jetson_id, len(data))
+                
+                # Send the header followed by the image data. sendall returns once the frame is
+                # copied into the kernel buffer, so time until the Pi has acknowledged all of it
+                send_start = time.monotonic()
+                self._send_frame(sock, header, data)
+                self._wait_for_delivery(sock, stop_event)
+                self._adapt_jpeg_quality(time.monotonic() - send_start)
+                print(f"Sent {len(data)} bytes to Raspberry Pi from ID {self.jetson_id}, next JPEG quality {self.jpeg_quality}.")
+            except OSError as e:
+                print(f"Failed to send image: {e}")
+                # Drop the broken connection; the next frame reconnects
+                self._close_socket(sock)
+                sock = None
+            except Exception as e:
+                print(f"Failed to send image: {e}")
+
+        self._close_socket(sock)
 
     # --- NO OTHER CHANGES ARE NEEDED FOR THE REST OF THE SCRIPT ---
     # (The rest of your GUI and camera control code remains the same)
@@ -114,6 +329,8 @@ class RealTimeAnalysisApp:
         self.contrast_entry.insert(0, f"{self.contrast_value.get():.3f}")
         self.contrast_entry.bind("<Return>", self.set_contrast_value)
 
+        tk.Checkbutton(control_frame, text="Colour (applies on next start)", variable=self.color_value).pack(pady=5, anchor="w")
+
         tk.Button(control_frame, text="Start Camera", command=self.start_camera).pack(fill=tk.X, pady=5)
         tk.Button(control_frame, text="Stop Camera", command=self.stop_camera).pack(fill=tk.X, pady=5)
 
@@ -162,12 +379,41 @@ class RealTimeAnalysisApp:
         except ValueError:
             messagebox.showerror("Invalid Input", "Please enter a valid float for contrast.")
 
+    def _queue_camera_update(self, feature, variable):
+        """Records a changed control value to be written to the camera before the next grab."""
+        try:
+            value = variable.get()
+        except tk.TclError:
+            return
+        with self.camera_update_lock:
+            self.pending_camera_updates[feature] = value
+
+    def _apply_camera_updates(self):
+        """Writes pending control changes to the camera, one register write per changed feature."""
+        with self.camera_update_lock:
+            updates = self.pending_camera_updates
+            self.pending_camera_updates = {}
+        for feature, value in updates.items():
+            getattr(self.camera, feature).SetValue(value)
+
     def start_camera(self):
         if not self.camera_running:
             self.camera_running = True
+            self.color_output = self.color_value.get()
+            self.last_sent_hash = None
+            # Each run gets its own stop event and queues, so threads from a previous run that
+            # outlived stop_camera's join timeout still see their stop and cannot take this run's frames
+            self.stop_sending = threading.Event()
+            self.encode_q = queue.Queue(maxsize=1)
+            self.send_q = queue.Queue(maxsize=1)
             threading.Thread(target=self.start_basler_camera, daemon=True).start()
-            self.stop_sending.clear()
-            self.send_thread = threading.Thread(target=self.send_image_periodically, daemon=True)
+            self.encode_thread = threading.Thread(
+                target=self._encoder_thread, args=(self.encode_q, self.send_q, self.stop_sending), daemon=True
+            )
+            self.encode_thread.start()
+            self.send_thread = threading.Thread(
+                target=self._sender_thread, args=(self.send_q, self.stop_sending), daemon=True
+            )
             self.send_thread.start()
 
     def start_basler_camera(self):
@@ -177,10 +423,29 @@ class RealTimeAnalysisApp:
             self.camera.ExposureTime.SetValue(self.exposure_value.get())
             self.camera.BslBrightness.SetValue(self.brightness_value.get())
             self.camera.BslContrast.SetValue(self.contrast_value.get())
+            if self.color_output:
+                # Set a colour format explicitly; the camera may still be in Mono8 from an earlier run
+                available_formats = self.camera.PixelFormat.Symbolics
+                color_format = next((f for f in COLOR_PIXEL_FORMATS if f in available_formats), None)
+                if color_format is None:
+                    raise RuntimeError("Camera does not support a colour pixel format")
+                self.camera.PixelFormat.SetValue(color_format)
+            else:
+                self.camera.PixelFormat.SetValue('Mono8')
+            try:
+                # Larger USB3 transfers; not every transport layer exposes this
+                self.camera.StreamGrabber.MaxTransferSize.SetValue(4194304)
+            except Exception as e:
+                print(f"Could not set MaxTransferSize: {e}")
             self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
             self.converter = pylon.ImageFormatConverter()
-            self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+            self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed if self.color_output else pylon.PixelType_Mono8
             self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+            if NvJpeg is not None and self.jpeg_encoder is None:
+                try:
+                    self.jpeg_encoder = NvJpeg()
+                except Exception as e:
+                    print(f"NVJPEG unavailable, using CPU JPEG encoding: {e}")
             self.update_video_feed()
         except Exception as e:
             messagebox.showerror("Camera Error", f"Failed to start camera: {e}")
@@ -189,16 +454,26 @@ class RealTimeAnalysisApp:
     def update_video_feed(self):
         if self.camera_running and self.camera.IsGrabbing():
             try:
+                self._apply_camera_updates()
                 grab_result = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
+                # Drain results that queued up while rendering so only the newest frame is used
+                while self.camera.GetGrabResultWaitObject().Wait(0):
+                    newer_result = self.camera.RetrieveResult(0, pylon.TimeoutHandling_Return)
+                    if not newer_result.IsValid():
+                        break
+                    grab_result.Release()
+                    grab_result = newer_result
                 if grab_result.GrabSucceeded():
-                    self.camera.ExposureTime.SetValue(self.exposure_value.get())
-                    self.camera.BslBrightness.SetValue(self.brightness_value.get())
-                    self.camera.BslContrast.SetValue(self.contrast_value.get())
                     image = self.converter.Convert(grab_result)
                     frame = image.GetArray()
                     self.latest_frame = cv2.resize(frame, (self.processing_width, self.processing_height))
-                    display_frame_rgb = cv2.cvtColor(self.latest_frame, cv2.COLOR_BGR2RGB)
-                    img = Image.fromarray(display_frame_rgb)
+                    self._put_latest(self.encode_q, self.latest_frame)
+                    preview = cv2.resize(self.latest_frame, (self.preview_width, self.preview_height))
+                    if preview.ndim == 2:
+                        img = Image.frombuffer('L', (self.preview_width, self.preview_height), preview, 'raw', 'L', 0, 1)
+                    else:
+                        # Let PIL swap BGR to RGB while unpacking instead of a separate cvtColor pass
+                        img = Image.frombuffer('RGB', (self.preview_width, self.preview_height), preview, 'raw', 'BGR', 0, 1)
                     imgtk = ImageTk.PhotoImage(image=img)
                     self.video_frame.imgtk = imgtk
                     self.video_frame.configure(image=imgtk)
@@ -210,8 +485,20 @@ class RealTimeAnalysisApp:
     def stop_camera(self):
         self.camera_running = False
         self.stop_sending.set()
+        # Stop the pipeline front to back so no encoded frame lands behind the sentinel
+        self._put_latest(self.encode_q, None)
+        if self.encode_thread:
+            self.encode_thread.join(timeout=2.0)
+        self._put_latest(self.send_q, None)
+        # Interrupt a sendall stuck on a slow or broken link so the GUI doesn't hang
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         if self.send_thread:
-            self.send_thread.join()
+            self.send_thread.join(timeout=2.0)
         if self.camera and self.camera.IsGrabbing():
             self.camera.StopGrabbing()
         if self.camera:
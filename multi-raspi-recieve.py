@@ -5,20 +5,34 @@ import socket
 import struct
 import io
 import os
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QGridLayout, QWidget, QStatusBar
-from PySide6.QtCore import Qt, QThread, Signal, QObject, Slot
-from PySide6.QtGui import QPixmap, QFont
+from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QGridLayout, QWidget, QStatusBar, QPushButton
+from PySide6.QtCore import Qt, QThread, Signal, QObject, Slot, QByteArray, QMutex, QMutexLocker, QTimer
+from PySide6.QtGui import QPixmap, QImage, QFont
 
 # --- CONFIGURATION ---
 GRID_ROWS = 2
 GRID_COLS = 3
+# TCP keepalive on Jetson connections: a dead Jetson is detected after ~50 s (30 + 4 * 5)
+TCP_KEEPALIVE_IDLE = 30
+TCP_KEEPALIVE_INTERVAL = 5
+TCP_KEEPALIVE_COUNT = 4
 # ---------------------
 
+# Frame header: [ID (1 byte)][LENGTH (4 bytes, big-endian)], compiled once.
+# The 4-byte length caps a single frame at 4 GB, far above any JPEG we send.
+_HDR = struct.Struct('>BL')
+# A 720p JPEG is a few hundred KB; a larger length means a corrupt header or a desynced stream,
+# and is rejected before recvall commits a buffer of that size.
+MAX_FRAME_BYTES = 8 * 1024 * 1024
+
 class NetworkWorker(QObject):
     """Handles network communication and emits signals with received data."""
-    # NEW SIGNAL: Emits Jetson ID (int) and image data (bytes)
-    image_received = Signal(int, bytes)
+    # Emits Jetson ID (int) and the raw JPEG (QByteArray) for archiving; display images go through pending_images
+    image_received = Signal(int, QByteArray)
     status_update = Signal(str)
 
     def __init__(self, host='0.0.0.0', port=65432):
@@ -27,21 +41,43 @@ class NetworkWorker(QObject):
         self.port = port
         self.running = False
         self.server_socket = None
+        self.target_size = (640, 480) # Display size images are scaled to, updated by the GUI
+        # Newest scaled image per Jetson ID, collected by the GUI's repaint timer
+        self.pending_images = {}
+        self.pending_lock = QMutex()
+        # One worker per Jetson plus headroom, so reconnect bursts can't spawn unbounded threads
+        self.pool = ThreadPoolExecutor(max_workers=GRID_ROWS * GRID_COLS + 2)
+        self.connections = set()
+        # Live connection per Jetson ID; a reconnecting Jetson evicts its stale socket
+        self.connections_by_id = {}
+        self.connections_lock = threading.Lock()
 
     def start_server(self):
         self.running = True
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(10) # Listen for up to 10 connections
+        self.server_socket.listen(64) # Room for a reconnect burst from every Jetson
         self.status_update.emit(f"Listening on port {self.port}...")
 
         while self.running:
             try:
                 conn, addr = self.server_socket.accept()
-                # Spawn a new thread to handle this specific client
-                client_thread = threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True)
-                client_thread.start()
+                try:
+                    # Disable Nagle so headers aren't held back, and use keepalive to reap dead Jetsons
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    if hasattr(socket, 'TCP_KEEPIDLE'):
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+                except OSError as e:
+                    # The peer already reset this connection; drop it without stopping the server
+                    self.status_update.emit(f"Dropping connection from {addr[0]}:{addr[1]}: {e}")
+                    conn.close()
+                    continue
+                # Hand this specific client to a pooled worker thread
+                self.pool.submit(self.handle_client, conn, addr)
             except OSError:
                 if self.running: self.status_update.emit("Server socket was closed.")
                 break
@@ -49,44 +85,119 @@ class NetworkWorker(QObject):
                 self.status_update.emit(f"Error accepting connections: {e}")
 
     def handle_client(self, conn, addr):
-        """Receives image data from a single connected client."""
+        """Receives image data from a single connected client until it disconnects."""
         self.status_update.emit(f"Connection from {addr[0]}:{addr[1]}")
+        registered_id = None
+        with self.connections_lock:
+            self.connections.add(conn)
         with conn:
             try:
-                # NEW PROTOCOL: [ID (1 byte)][LENGTH (4 bytes)][IMAGE DATA]
-                header_data = self.recvall(conn, 5) # Read the first 5 bytes (ID + Length)
-                if not header_data:
-                    return
+                # The sender keeps the connection open and streams one record per frame
+                while self.running:
+                    # NEW PROTOCOL: [ID (1 byte)][LENGTH (4 bytes)][IMAGE DATA]
+                    header_data = self.recvall(conn, _HDR.size) # Read the first 5 bytes (ID + Length)
+                    if not header_data:
+                        break
+
+                    jetson_id, data_len = _HDR.unpack(header_data)
+                    if data_len > MAX_FRAME_BYTES:
+                        # The stream can't be resynchronised, so drop the connection; the sender reconnects
+                        self.status_update.emit(f"Rejected {data_len}-byte frame from {addr[0]}:{addr[1]}; closing connection.")
+                        break
+                    if jetson_id != registered_id:
+                        self.register_connection(jetson_id, conn)
+                        registered_id = jetson_id
+                    
+                    img_data = self.recvall(conn, data_len)
+                    if not img_data:
+                        break
 
-                jetson_id, data_len = struct.unpack('>BL', header_data)
-                
-                img_data = self.recvall(conn, data_len)
-                if not img_data:
-                    return
+                    self.status_update.emit(f"Received {len(img_data) / 1024:.2f} KB from Jetson ID {jetson_id}.")
 
-                self.status_update.emit(f"Received {len(img_data) / 1024:.2f} KB from Jetson ID {jetson_id}.")
-                self.image_received.emit(jetson_id, img_data)
+                    # Decode and scale here so the GUI thread only has to show the result
+                    raw_data = QByteArray(img_data)
+                    image = QImage.fromData(raw_data, "JPG")
+                    if image.isNull():
+                        self.status_update.emit(f"Failed to decode image from Jetson ID {jetson_id}.")
+                        continue
+                    width, height = self.target_size
+                    scaled_image = image.scaled(
+                        width, height,
+                        Qt.AspectRatioMode.KeepAspectRatio,
+                        Qt.TransformationMode.FastTransformation
+                    )
+                    with QMutexLocker(self.pending_lock):
+                        self.pending_images[jetson_id] = scaled_image
+                    self.image_received.emit(jetson_id, raw_data)
 
             except Exception as e:
                 self.status_update.emit(f"Error handling client {addr}: {e}")
+            finally:
+                with self.connections_lock:
+                    self.connections.discard(conn)
+                    if self.connections_by_id.get(registered_id) is conn:
+                        del self.connections_by_id[registered_id]
+        self.status_update.emit(f"Connection from {addr[0]}:{addr[1]} closed.")
+
+    def register_connection(self, jetson_id, conn):
+        """Makes conn the live connection for a Jetson, shutting down the one it replaces."""
+        # A Jetson that reconnects leaves a half-open socket behind; shut it down so it
+        # stops holding one of the pool's workers
+        with self.connections_lock:
+            stale_conn = self.connections_by_id.get(jetson_id)
+            self.connections_by_id[jetson_id] = conn
+        if stale_conn is not None and stale_conn is not conn:
+            try:
+                stale_conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def recvall(self, sock, n):
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet: return None
-            data.extend(packet)
+        # Receive straight into a preallocated buffer instead of copying each packet
+        data = bytearray(n)
+        view = memoryview(data)
+        received = 0
+        while received < n:
+            count = sock.recv_into(view[received:], n - received)
+            if count == 0: return None
+            received += count
         return data
 
+    def take_pending_images(self):
+        """Returns and clears the newest scaled image received from each Jetson."""
+        with QMutexLocker(self.pending_lock):
+            pending = self.pending_images
+            self.pending_images = {}
+        return pending
+
+    def set_target_size(self, width, height):
+        self.target_size = (width, height)
+
     def stop(self):
         self.running = False
         if self.server_socket:
+            # shutdown() wakes the thread blocked in accept(); close() alone does not on Linux
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.server_socket.close()
+        # Wake workers blocked in recv so the pool can wind down
+        with self.connections_lock:
+            for conn in self.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.pool.shutdown(wait=False, cancel_futures=True)
         self.status_update.emit("Server stopped.")
 
 
 class MultiImageReceiverApp(QMainWindow):
     """Main application window with a grid display for multiple camera feeds."""
+    # Lets the disk-writer thread report errors through the GUI thread
+    save_failed = Signal(str)
+
     def __init__(self, rows, cols):
         super().__init__()
         self.setWindowTitle("Multi-Camera Receiver (Raspberry Pi CM5)")
@@ -118,57 +229,101 @@ class MultiImageReceiverApp(QMainWindow):
         if not os.path.exists(self.image_dir):
             os.makedirs(self.image_dir)
 
+        # Received images are written by a background thread so disk I/O never blocks the GUI
+        self.record_enabled = True
+        self.record_button = QPushButton("Recording")
+        self.record_button.setCheckable(True)
+        self.record_button.setChecked(self.record_enabled)
+        self.record_button.toggled.connect(self.set_recording)
+        self.status_bar.addPermanentWidget(self.record_button)
+        self.save_failed.connect(self.show_status_message)
+        self.save_queue = queue.Queue()
+        self.save_thread = threading.Thread(target=self.save_worker, daemon=True)
+        self.save_thread.start()
+
         self.setup_network_thread()
 
+        # Repaint at a bounded rate no matter how fast images arrive
+        self.repaint_timer = QTimer(self)
+        self.repaint_timer.setInterval(33)
+        self.repaint_timer.timeout.connect(self.repaint_images)
+        self.repaint_timer.start()
+
     def setup_network_thread(self):
         self.thread = QThread()
         self.worker = NetworkWorker()
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.start_server)
-        self.worker.image_received.connect(self.update_image)
+        self.worker.image_received.connect(self.archive_image)
         self.worker.status_update.connect(self.show_status_message)
         self.thread.start()
 
-    @Slot(int, bytes)
-    def update_image(self, jetson_id, img_data):
-        """Slot to handle new image data and update the correct label in the grid."""
+    @Slot(int, QByteArray)
+    def archive_image(self, jetson_id, img_data):
+        """Slot to record a received image; display is handled by repaint_images."""
         if jetson_id not in self.image_labels:
             self.show_status_message(f"Received image from unknown Jetson ID: {jetson_id}")
             return
+        self.save_image(img_data, jetson_id)
 
-        try:
-            pixmap = QPixmap()
-            pixmap.loadFromData(img_data, "JPG")
-            
-            self.save_image(pixmap, jetson_id)
-
-            label_to_update = self.image_labels[jetson_id]
-            scaled_pixmap = pixmap.scaled(
-                label_to_update.size(),
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation
-            )
-            label_to_update.setPixmap(scaled_pixmap)
-
-        except Exception as e:
-            self.show_status_message(f"Error displaying image from ID {jetson_id}: {e}")
+    @Slot()
+    def repaint_images(self):
+        """Shows the newest image from each Jetson that sent one since the last tick."""
+        for jetson_id, scaled_image in self.worker.take_pending_images().items():
+            if jetson_id not in self.image_labels:
+                continue
+            try:
+                self.image_labels[jetson_id].setPixmap(QPixmap.fromImage(scaled_image))
+            except Exception as e:
+                self.show_status_message(f"Error displaying image from ID {jetson_id}: {e}")
 
     @Slot(str)
     def show_status_message(self, message):
         print(message)
         self.status_bar.showMessage(message, 5000)
 
-    def save_image(self, pixmap, jetson_id):
+    @Slot(bool)
+    def set_recording(self, enabled):
+        self.record_enabled = enabled
+        self.record_button.setText("Recording" if enabled else "Not Recording")
+
+    def save_image(self, img_data, jetson_id):
+        if not self.record_enabled:
+            return
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = os.path.join(self.image_dir, f"jetson_image_ID_{jetson_id}_{timestamp}.jpg")
-        if not pixmap.save(filename, "JPG"):
-            self.show_status_message(f"Failed to save image {filename}")
+        self.save_queue.put((filename, img_data))
+
+    def save_worker(self):
+        """Writes queued JPEGs to disk exactly as sent, without re-encoding."""
+        while True:
+            item = self.save_queue.get()
+            if item is None:
+                break
+            filename, img_data = item
+            try:
+                with open(filename, 'wb') as f:
+                    f.write(img_data.data())
+            except OSError as e:
+                self.save_failed.emit(f"Failed to save image {filename}: {e}")
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if not hasattr(self, 'worker'):
+            return
+        # All grid cells share one size; the worker scales incoming images to it
+        label = next(iter(self.image_labels.values()))
+        self.worker.set_target_size(label.width(), label.height())
 
     def closeEvent(self, event):
         self.show_status_message("Closing application...")
+        self.repaint_timer.stop()
         self.worker.stop()
         self.thread.quit()
         self.thread.wait()
+        # Flush images still waiting to be written
+        self.save_queue.put(None)
+        self.save_thread.join()
         event.accept()
 
 if __name__ == "__main__":